@@ -6,14 +6,42 @@ Reference:  Iterative Normalization: Beyond Standardization towards Efficient Wh
 """
 import torch.nn
 import torch.nn.functional as F
+from torch.cuda.amp import custom_fwd, custom_bwd
 from torch.nn import Parameter
 
 # import extension._bcnn as bcnn
 
-__all__ = ['iterative_normalization', 'IterNorm']
+__all__ = ['iterative_normalization', 'IterNorm', 'whiten_and_rotate']
+
+
+@torch.jit.script
+def whiten_and_rotate(X, running_mean, running_wm, running_rot):
+    """
+    Eval-mode whitening + rotation as a single TorchScript graph.
+
+    This is the math the plotting hooks re-implement on top of
+    iterative_normalization_py.apply: center with the running mean,
+    whiten with the running whitening matrix, rotate with the running
+    rotation. The hooks always run under eval, so the Newton iteration
+    and the running-stat updates of the training branch are not needed,
+    and compiling the chain removes the Python dispatch the hook would
+    otherwise pay per batch.
+    """
+    num_channels = running_wm.size(-1)
+    g = X.size(1) // num_channels
+    x = X.transpose(0, 1).contiguous().view(g, num_channels, -1)
+    xn = running_wm.matmul(x - running_mean)
+    X_hat = xn.view(X.size(1), X.size(0), X.size(2), X.size(3)).transpose(0, 1).contiguous()
+    # bgchw, rotate each group with its rotation matrix
+    X_hat = X_hat.view(X.size(0), running_rot.size(0), running_rot.size(2), X.size(2), X.size(3))
+    X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, running_rot)
+    return X_hat.view(X.size(0), X.size(1), X.size(2), X.size(3))
 
 class iterative_normalization_py(torch.autograd.Function):
+    # the Newton iteration is numerically unstable in FP16, so run the
+    # whitening in FP32 even inside an autocast region
     @staticmethod
+    @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, *args, **kwargs):
         X, running_mean, running_wmat, nc, ctx.T, eps, momentum, training = args
         # change NxCxHxW to (G x D) x(NxHxW), i.e., g*d*m
@@ -50,6 +78,7 @@ class iterative_normalization_py(torch.autograd.Function):
         return Xn
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, *grad_outputs):
         grad, = grad_outputs
         saved = ctx.saved_variables
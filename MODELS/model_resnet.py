@@ -36,37 +36,32 @@ class ResidualNetTransfer(nn.Module):
             elif whitened_layer <= layers[0] + layers[1] + layers[2] + layers[3]:
                 self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1 = cw_layer(512, activation_mode = args.act_mode)
     
+    def bn1_modules(self):
+        """
+        bn1 modules of all residual blocks as a flat list, indexed by
+        whitened_layer - 1
+        """
+        return [block.bn1 for layer in (self.model.layer1, self.model.layer2,
+                                        self.model.layer3, self.model.layer4)
+                for block in layer]
+
     def change_mode(self, mode):
         """
         Change the training mode
         mode = -1, no update for gradient matrix G
              = 0 to k-1, the column index of gradient matrix G that needs to be updated
         """
-        layers = self.layers
+        bn1_modules = self.bn1_modules()
         for whitened_layer in self.whitened_layers:
-            if whitened_layer <= layers[0]:
-                self.model.layer1[whitened_layer-1].bn1.mode = mode
-            elif whitened_layer <= layers[0] + layers[1]:
-                self.model.layer2[whitened_layer-layers[0]-1].bn1.mode = mode
-            elif whitened_layer <= layers[0] + layers[1] + layers[2]:
-                self.model.layer3[whitened_layer-layers[0]-layers[1]-1].bn1.mode = mode
-            elif whitened_layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1.mode = mode
-    
+            bn1_modules[whitened_layer-1].mode = mode
+
     def update_rotation_matrix(self):
         """
         update the rotation R using accumulated gradient G
         """
-        layers = self.layers
+        bn1_modules = self.bn1_modules()
         for whitened_layer in self.whitened_layers:
-            if whitened_layer <= layers[0]:
-                self.model.layer1[whitened_layer-1].bn1.update_rotation_matrix()
-            elif whitened_layer <= layers[0] + layers[1]:
-                self.model.layer2[whitened_layer-layers[0]-1].bn1.update_rotation_matrix()
-            elif whitened_layer <= layers[0] + layers[1] + layers[2]:
-                self.model.layer3[whitened_layer-layers[0]-layers[1]-1].bn1.update_rotation_matrix()
-            elif whitened_layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1.update_rotation_matrix()
+            bn1_modules[whitened_layer-1].update_rotation_matrix()
 
     def forward(self, x):
         return self.model(x)
@@ -49,6 +49,17 @@ class ImageFolderWithPaths(datasets.ImageFolder):
         return tuple_with_path
 
 
+'''
+    Flatten the bn1 modules of all residual blocks into one list, so a
+    whitened layer index maps to its module by direct indexing instead of
+    recomputing the layers[0]+layers[1]+... offsets in a 4-way if-elif
+    chain at every use site.
+'''
+def get_bn1_modules(model):
+    return [block.bn1 for layer in (model.layer1, model.layer2, model.layer3, model.layer4)
+            for block in layer]
+
+
 '''
     This function finds the top 50 images that gets the greatest activations with respect to the concepts.
     Concept activation values are obtained based on iternorm_rotation module outputs.
@@ -73,34 +84,22 @@ def plot_concept_top50(args, val_loader, model, whitened_layers, print_other = F
         os.mkdir(folder)
     
     model = model.module
-    layers = model.layers
     if args.arch == "resnet_cw":
         model = model.model
 
     outputs= []
     def hook(module, input, output):
-        from MODELS.iterative_normalization import iterative_normalization_py
-        X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                 module.eps, module.momentum, module.training)
-        size_X = X_hat.size()
-        size_R = module.running_rot.size()
-        X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
+        from MODELS.iterative_normalization import whiten_and_rotate
+        X_hat = whiten_and_rotate(input[0], module.running_mean,
+                                  module.running_wm, module.running_rot)
 
-        X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-        X_hat = X_hat.view(*size_X)
+        # keep the feature map on device; it is reduced to one scalar per
+        # image before anything is copied back to the host
+        outputs.append(X_hat)
 
-        outputs.append(X_hat.cpu().numpy())
-    
     for layer in layer_list:
         layer = int(layer)
-        if layer <= layers[0]:
-            model.layer1[layer-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1]:
-            model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2]:
-            model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-            model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+        get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
     begin = 0
     end = len(args.concepts.split(','))
@@ -120,55 +119,53 @@ def plot_concept_top50(args, val_loader, model, whitened_layers, print_other = F
             if not os.path.exists(output_path):
                 os.mkdir(output_path)
             paths = []
-            vals = None
+            # preallocate on device instead of growing vals with np.concatenate
+            # per batch, which reallocates and copies the whole array every
+            # iteration; a single .cpu() after the loop replaces the
+            # device-to-host sync previously paid per layer per batch
+            vals = torch.empty((len(layer_list), len(val_loader.dataset)), device='cuda')
+            off = 0
             for i, (input, _, path) in enumerate(val_loader):
                 paths += list(path)
-                input_var = torch.autograd.Variable(input).cuda()
+                input_var = input.cuda()
                 outputs = []
                 model(input_var)
                 val = []
                 for output in outputs:
                     if activation_mode == 'mean':
-                        val = np.concatenate((val,output.mean((2,3))[:,k]))
+                        val.append(output.mean(dim=(2,3))[:,k])
                     elif activation_mode == 'max':
-                        val = np.concatenate((val,output.max((2,3))[:,k]))
+                        val.append(output.amax(dim=(2,3))[:,k])
                     elif activation_mode == 'pos_mean':
-                        pos_bool = (output > 0).astype('int32')
+                        pos_bool = (output > 0).to(output)
                         act = (output * pos_bool).sum((2,3))/(pos_bool.sum((2,3))+0.0001)
-                        val = np.concatenate((val,act[:,k]))
+                        val.append(act[:,k])
                     elif activation_mode == 'pool_max':
                         kernel_size = 3
-                        r = output.shape[3] % kernel_size
-                        if r == 0:
-                            val = np.concatenate((val,skimage.measure.block_reduce(output[:,:,:,:],(1,1,kernel_size,kernel_size),np.max).mean((2,3))[:,k]))
-                        else:
-                            val = np.concatenate((val,skimage.measure.block_reduce(output[:,:,:-r,:-r],(1,1,kernel_size,kernel_size),np.max).mean((2,3))[:,k]))
+                        # floor mode drops the trailing remainder, like the
+                        # [:,:,:-r,:-r] crop did for block_reduce
+                        act = nn.functional.max_pool2d(output, kernel_size).mean(dim=(2,3))
+                        val.append(act[:,k])
                     elif activation_mode == 'pool_max_s1':
-                        X_test = torch.Tensor(output)
-                        maxpool_value, maxpool_indices = nn.functional.max_pool2d(X_test, kernel_size=3, stride=1, return_indices=True)
+                        maxpool_value, maxpool_indices = nn.functional.max_pool2d(output, kernel_size=3, stride=1, return_indices=True)
                         X_test_unpool = nn.functional.max_unpool2d(maxpool_value,maxpool_indices, kernel_size=3, stride =1)
-                        maxpool_bool = X_test == X_test_unpool
-                        act = (X_test_unpool.sum((2,3)) / maxpool_bool.sum((2,3)).float()).numpy()
-                        val = np.concatenate((val,act[:,k]))
+                        maxpool_bool = output == X_test_unpool
+                        act = X_test_unpool.sum((2,3)) / maxpool_bool.sum((2,3)).float()
+                        val.append(act[:,k])
 
-                val = val.reshape((len(outputs),-1))
-                if i == 0:
-                    vals = val
-                else:
-                    vals = np.concatenate((vals,val),1)
+                val = torch.stack(val)
+                bsz = val.size(1)
+                vals[:, off:off+bsz] = val
+                off += bsz
+            vals = vals[:, :off].cpu().numpy()
 
+            paths_arr = np.asarray(paths)
             for i, layer in enumerate(layer_list):
-                arr = list(zip(list(vals[i,:]),list(paths)))
-                arr.sort(key = lambda t: t[0], reverse = True)
-                # arr.sort(key = lambda t: t[0], reverse = False)
-                # with open('76dim.txt', 'w') as f:
-                #     for item in arr:
-                #         f.write(item[1]+'\n')
-
-                for j in range(5):
-                    src = arr[j][1]
-                    copyfile(src, output_path+'/'+'layer'+layer+'_'+str(j+1)+'.jpg')  
-                    # copyfile(src, output_path+'/'+'layer'+layer+'_'+str(j+1)+'_reversed.jpg')  
+                # partial sort in C instead of a Python sort over (val, path) tuples
+                top = torch.from_numpy(vals[i,:]).topk(5)
+                for j, idx in enumerate(top.indices.tolist()):
+                    src = paths_arr[idx]
+                    copyfile(src, output_path+'/'+'layer'+layer+'_'+str(j+1)+'.jpg')
 
     return 0
 
@@ -180,7 +177,6 @@ def get_layer_representation(args, val_loader, layer, cpt_idx):
     with torch.no_grad():        
         model.eval()
         model = model.module
-        layers = model.layers
         if args.arch == "resnet_cw":
             model = model.model
         outputs= []
@@ -194,32 +190,27 @@ def get_layer_representation(args, val_loader, layer, cpt_idx):
             size_R = module.running_rot.size()
             X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
 
-            X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-            #print(size_X)
-            X_hat = X_hat.view(*size_X)
+            # the rotation is linear, so collapse HxW before applying it and
+            # rotate the small (b, g, c) summary instead of the full feature map
+            X_hat = X_hat.sum(dim=(-2, -1))
+            X_hat = torch.einsum('bgc,gdc->bgd', X_hat, module.running_rot)
+            X_hat = X_hat.reshape(size_X[0], size_X[1])
 
             outputs.append(X_hat.cpu().numpy())
-            
+
         layer = int(layer)
-        if layer <= layers[0]:
-            model.layer1[layer-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1]:
-            model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2]:
-            model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-            model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+        get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
         paths = []
         vals = None
         for i, (input, _, path) in enumerate(val_loader):
             paths += list(path)
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             outputs = []
             model(input_var)
             val = []
             for output in outputs:
-                val.append(output.sum((2,3))[:, cpt_idx])
+                val.append(output[:, cpt_idx])
             val = np.array(val)
             if i == 0:
                 vals = val
@@ -240,7 +231,6 @@ def get_representation_distance_to_center(args, val_loader, layer, arch='resnet_
     with torch.no_grad():
         model.eval()
         model = model.module
-        layers = model.layers
         if args.arch == "resnet_cw":
             model = model.model
         outputs= []
@@ -250,29 +240,14 @@ def get_representation_distance_to_center(args, val_loader, layer, arch='resnet_
                 #outputs.append(input[0].cpu().numpy())
                 outputs.append(output.cpu().numpy())
             else:
-                from MODELS.iterative_normalization import iterative_normalization_py
-                #print(input)
-                X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                    module.eps, module.momentum, module.training)
-                size_X = X_hat.size()
-                size_R = module.running_rot.size()
-                X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-                X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-                #print(size_X)
-                X_hat = X_hat.view(*size_X)
+                from MODELS.iterative_normalization import whiten_and_rotate
+                X_hat = whiten_and_rotate(input[0], module.running_mean,
+                                          module.running_wm, module.running_rot)
 
                 outputs.append(X_hat.cpu().numpy())
             
         layer = int(layer)
-        if layer <= layers[0]:
-            model.layer1[layer-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1]:
-            model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2]:
-            model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-            model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+        get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
         paths = []
         vals = []
@@ -280,7 +255,7 @@ def get_representation_distance_to_center(args, val_loader, layer, arch='resnet_
             #paths += list(path)
             # if i==500:
             #     break
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             outputs = []
             model(input_var)
             for output in outputs:
@@ -326,7 +301,6 @@ def intra_concept_dot_product_vs_inter_concept_dot_product(args, conceptdir, lay
     model = load_resnet_model(args, arch=arch, depth=18, whitened_layer=layer, dataset = dataset)
     model.eval()
     model = model.module
-    layers = model.layers
     # if arch == "resnet_cw" or arch == "resnet_baseline":
     model = model.model
     
@@ -344,43 +318,27 @@ def intra_concept_dot_product_vs_inter_concept_dot_product(args, conceptdir, lay
                     #outputs.append(input[0].cpu().numpy())
                     outputs.append(output.cpu().numpy())
                 else:
-                    from MODELS.iterative_normalization import iterative_normalization_py
-                    #print(input)
-                    X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                            module.eps, module.momentum, module.training)
-                    size_X = X_hat.size()
-                    size_R = module.running_rot.size()
-                    X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-                    X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-                    #print(size_X)
-                    X_hat = X_hat.view(*size_X)
+                    from MODELS.iterative_normalization import whiten_and_rotate
+                    X_hat = whiten_and_rotate(input[0], module.running_mean,
+                                              module.running_wm, module.running_rot)
 
                     outputs.append(X_hat.cpu().numpy())
                 
             layer = int(layer)
-            if layer <= layers[0]:
-                model.layer1[layer-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1]:
-                model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+            get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
             print(c, cpt)
             for j, (input, y, path) in enumerate(concept_loader):
-                labels = y.cpu().numpy().flatten().astype(np.int32).tolist()
-                input_var = torch.autograd.Variable(input).cuda()
+                labels = y.cpu().numpy().flatten().astype(np.int32)
+                input_var = input.cuda()
                 outputs = []
                 model(input_var)
-                for instance_index in range(len(labels)): # batch size
-                    instance_concept_index = labels[instance_index]
+                # per-image channel means for the whole batch in one
+                # reduction instead of a transpose/reshape/mean per instance
+                batch_means = outputs[0].mean(axis=(2, 3))
+                for instance_index, instance_concept_index in enumerate(labels):
                     if concept_list[instance_concept_index] in plot_cpt: # only get the representation of concepts of instances from plot_cpt list
-                        representation_concept_index = plot_cpt.index(concept_list[instance_concept_index])
-                        output_shape = outputs[0].shape
-                        representation_mean = outputs[0][instance_index:instance_index+1, :, :, :].transpose((0,2,3,1)).reshape((-1, output_shape[1])).mean(axis=0) # mean of all pixels of that instance
-                        representations[concept_list[instance_concept_index]].append(representation_mean) # get the cpt_index channel of the output
+                        representations[concept_list[instance_concept_index]].append(batch_means[instance_index])
 
     # representation of concepts in matrix form
     dot_product_matrix = np.zeros((len(plot_cpt),len(plot_cpt))).astype('float')
@@ -518,41 +476,25 @@ def plot_auc_cw(args, conceptdir, whitened_layers, plot_cpt = ['airplane','bed',
             with torch.no_grad():
                 model.eval()
                 model = model.module
-                layers = model.layers
                 model = model.model
                 outputs= []
             
                 def hook(module, input, output):
-                    from MODELS.iterative_normalization import iterative_normalization_py
-                    #print(input)
-                    X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                            module.eps, module.momentum, module.training)
-                    size_X = X_hat.size()
-                    size_R = module.running_rot.size()
-                    X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-                    X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-                    #print(size_X)
-                    X_hat = X_hat.view(*size_X)
+                    from MODELS.iterative_normalization import whiten_and_rotate
+                    X_hat = whiten_and_rotate(input[0], module.running_mean,
+                                              module.running_wm, module.running_rot)
 
                     outputs.append(X_hat.cpu().numpy())
                     
                 layer = int(layer)
-                if layer <= layers[0]:
-                    model.layer1[layer-1].bn1.register_forward_hook(hook)
-                elif layer <= layers[0] + layers[1]:
-                    model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-                elif layer <= layers[0] + layers[1] + layers[2]:
-                    model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-                elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                    model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+                get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
                 labels = []
                 vals = []
                 for j, (input, y, path) in enumerate(concept_loader):
                     #print(y, path)
                     labels += list(y.cpu().numpy())
-                    input_var = torch.autograd.Variable(input).cuda()
+                    input_var = input.cuda()
                     outputs = []
                     model(input_var)
                     for output in outputs:
@@ -617,7 +559,6 @@ def plot_auc_lm(args, model, concept_loaders, train_loader, conceptdir, whitened
 
     model.eval()
     model = model.module
-    layers = model.layers
     model = model.model
 
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -642,21 +583,14 @@ def plot_auc_lm(args, model, concept_loaders, train_loader, conceptdir, whitened
         
         for layer in layer_list:
             layer = int(layer)
-            if layer <= layers[0]:
-                model.layer1[layer-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1]:
-                model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+            get_bn1_modules(model)[layer-1].register_forward_hook(hook)
         
         labels = []
         activation_test = None
         for i, (input, y) in enumerate(concept_loader_test):
             labels += list(y.cpu().numpy())
             outputs = []
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             model(input_var)
             if i == 0:
                 activation_test = outputs
@@ -674,7 +608,7 @@ def plot_auc_lm(args, model, concept_loaders, train_loader, conceptdir, whitened
                 if i == n_batch:
                     break
                 outputs = []
-                input_var = torch.autograd.Variable(input).cuda()
+                input_var = input.cuda()
                 model(input_var)
                 if i == 0:
                     activation = outputs
@@ -688,7 +622,7 @@ def plot_auc_lm(args, model, concept_loaders, train_loader, conceptdir, whitened
                 if i == n_batch:
                     break
                 outputs = []
-                input_var = torch.autograd.Variable(input).cuda()
+                input_var = input.cuda()
                 model(input_var)
                 for k in range(len(outputs)):
                     activation[k] = np.concatenate((activation[k], outputs[k]),0)
@@ -746,7 +680,6 @@ def plot_auc_filter(args, model, conceptdir, whitened_layers, plot_cpt = ['airpl
 
     model.eval()
     model = model.module
-    layers = model.layers
     model = model.model
 
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -772,21 +705,14 @@ def plot_auc_filter(args, model, conceptdir, whitened_layers, plot_cpt = ['airpl
         
         for layer in layer_list:
             layer = int(layer)
-            if layer <= layers[0]:
-                model.layer1[layer-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1]:
-                model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+            get_bn1_modules(model)[layer-1].register_forward_hook(hook)
         
         labels = []
         activation_test = None
         for i, (input, y) in enumerate(concept_loader_test):
             labels += list(y.cpu().numpy())
             outputs = []
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             model(input_var)
             if i == 0:
                 activation_test = outputs
@@ -896,7 +822,6 @@ def plot_concept_representation(args, val_loader, model, whitened_layers, plot_c
             os.mkdir(dst)
         model.eval()
         model = model.module
-        layers = model.layers
         layer_list = whitened_layers.split(',')
         dst = dst + '_'.join(layer_list) + '/'
         if args.arch == "resnet_cw":
@@ -906,30 +831,15 @@ def plot_concept_representation(args, val_loader, model, whitened_layers, plot_c
         outputs= []
     
         def hook(module, input, output):
-            from MODELS.iterative_normalization import iterative_normalization_py
-            #print(input)
-            X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                    module.eps, module.momentum, module.training)
-            size_X = X_hat.size()
-            size_R = module.running_rot.size()
-            X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-            X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-            #print(size_X)
-            X_hat = X_hat.view(*size_X)
+            from MODELS.iterative_normalization import whiten_and_rotate
+            X_hat = whiten_and_rotate(input[0], module.running_mean,
+                                      module.running_wm, module.running_rot)
 
             outputs.append(X_hat.cpu().numpy())
             
         for layer in layer_list:
             layer = int(layer)
-            if layer <= layers[0]:
-                model.layer1[layer-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1]:
-                model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+            get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
         concepts = args.concepts.split(',')
         cpt_idx = [concepts.index(plot_cpt[0]),concepts.index(plot_cpt[1])]
@@ -939,7 +849,7 @@ def plot_concept_representation(args, val_loader, model, whitened_layers, plot_c
         vals = None
         for i, (input, _, path) in enumerate(val_loader):
             paths += list(path)
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             outputs = []
             model(input_var)
             val = []
@@ -1015,7 +925,6 @@ def plot_correlation(args, val_loader, model, layer):
             os.mkdir(dst)
         model.eval()
         model = model.module
-        layers = model.layers
         model = model.model
         outputs= []
     
@@ -1026,17 +935,10 @@ def plot_correlation(args, val_loader, model, layer):
             outputs.append(M)
 
         layer = int(layer)
-        if layer <= layers[0]:
-            model.layer1[layer-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1]:
-            model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2]:
-            model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-        elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-            model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+        get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
         for i, (input, _, path) in enumerate(val_loader):
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             model(input_var)
             if i==50:
                 break
@@ -1065,22 +967,21 @@ def concept_permutation_importance(args, val_loader, layer, criterion, arch='res
     with torch.no_grad():
         model.eval()
         model = model.module
-        layers = model.layers
         if args.arch == "resnet_cw":
             model = model.model
 
         loss_avg = AverageMeter()
         accuracy_avg = AverageMeter()
         for i, (input, target) in enumerate(val_loader):
-            input_var = torch.autograd.Variable(input).cuda()
-            target_var = torch.autograd.Variable(target).cuda()
+            input_var = input.cuda()
+            target_var = target.cuda()
 
             output = model(input_var)
             loss = criterion(output, target_var)
-            loss_avg.update(loss.data, input.size(0))
+            loss_avg.update(loss.item(), input.size(0))
 
             [accuracy_batch] = accuracy(output.data, target_var, topk=(1,))
-            accuracy_avg.update(accuracy_batch, input.size(0))
+            accuracy_avg.update(accuracy_batch.item(), input.size(0))
         
         base_loss = loss_avg.avg
         print('base loss', base_loss)
@@ -1099,24 +1000,17 @@ def concept_permutation_importance(args, val_loader, layer, criterion, arch='res
                 return new_output
                 
             layer = int(layer)
-            if layer <= layers[0]:
-                model.layer1[layer-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1]:
-                model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+            get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
             for i, (input, target) in enumerate(val_loader):
-                input_var = torch.autograd.Variable(input).cuda()
-                target_var = torch.autograd.Variable(target).cuda()
+                input_var = input.cuda()
+                target_var = target.cuda()
 
                 output = model(input_var)
                 loss = criterion(output, target_var)
-                loss_avg.update(loss.data, input.size(0))
+                loss_avg.update(loss.item(), input.size(0))
                 [accuracy_batch] = accuracy(output.data, target_var, topk=(1,))
-                accuracy_avg.update(accuracy_batch, input.size(0))
+                accuracy_avg.update(accuracy_batch.item(), input.size(0))
             
             print(axis_to_permute, loss_avg.avg)
             permutation_loss.append(loss_avg.avg)
@@ -1159,8 +1053,8 @@ def concept_gradient_importance(args, val_loader, layer, criterion, arch='resnet
     concept_importance_per_class = [None] * num_classes
 
     for i, (input, target) in enumerate(val_loader):
-        input_var = torch.autograd.Variable(input).cuda()
-        target_var = torch.autograd.Variable(target).cuda()
+        input_var = input.cuda()
+        target_var = target.cuda()
         output = model(input_var)
         model.zero_grad()
         prediction_result = torch.argmax(output, dim=1).flatten().tolist()[0]
@@ -1192,15 +1086,14 @@ def saliency_map_class(args, val_loader, layer, arch='resnet_cw', dataset='isic'
     #print(model)
     # model.eval()
     model = model.module
-    layers = model.layers
     if args.arch == "resnet_cw":
         model = model.model
     
     print(model)
 
     for i, (input, target) in enumerate(val_loader):
-        input_var = torch.autograd.Variable(input).cuda()
-        target_var = torch.autograd.Variable(target).cuda()
+        input_var = input.cuda()
+        target_var = target.cuda()
         input_var.requires_grad = True
         output = model(input_var)
         model.zero_grad()
@@ -1231,7 +1124,6 @@ def saliency_map_concept(args, val_loader, layer, arch='resnet_cw', dataset='isi
     #print(model)
     # model.eval()
     model = model.module
-    layers = model.layers
     if args.arch == "resnet_cw":
         model = model.model
     
@@ -1243,14 +1135,7 @@ def saliency_map_concept(args, val_loader, layer, arch='resnet_cw', dataset='isi
         outputs.append(output)
     
     layer = int(layer)
-    if layer <= layers[0]:
-        model.layer1[layer-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1]:
-        model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2]:
-        model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-        model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+    get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
     for j in range(num_concepts):
         save_folder = os.path.join(dst, "concept_"+str(j))
@@ -1258,8 +1143,8 @@ def saliency_map_concept(args, val_loader, layer, arch='resnet_cw', dataset='isi
             os.mkdir(save_folder)
 
     for i, (input, target) in enumerate(val_loader):
-        input_var = torch.autograd.Variable(input).cuda()
-        target_var = torch.autograd.Variable(target).cuda()
+        input_var = input.cuda()
+        target_var = target.cuda()
         input_var.requires_grad = True
         for j in range(num_concepts):
             output = model(input_var)
@@ -1288,7 +1173,6 @@ def saliency_map_concept_cover(args, val_loader, layer, arch='resnet_cw', datase
     #print(model)
     model.eval()
     model = model.module
-    layers = model.layers
     if args.arch == "resnet_cw":
         model = model.model
     
@@ -1300,14 +1184,7 @@ def saliency_map_concept_cover(args, val_loader, layer, arch='resnet_cw', datase
         outputs.append(output)
     
     layer = int(layer)
-    if layer <= layers[0]:
-        model.layer1[layer-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1]:
-        model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2]:
-        model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-        model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+    get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
     for j in range(num_concepts):
         save_folder = os.path.join(dst, "concept_"+str(j))
@@ -1323,7 +1200,7 @@ def saliency_map_concept_cover(args, val_loader, layer, arch='resnet_cw', datase
     with torch.no_grad():
         for i, (input, target) in enumerate(val_loader):
             random_patch = torch.tensor(np.random.normal(size=(3,cover_size,cover_size)))
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             output = model(input_var)
             base_activations = nn.functional.max_pool2d(outputs[0], kernel_size=3, stride=3)
             base_activations = base_activations[0,:,:,:].clamp(min=0.0).mean(dim=(1,2))
@@ -1337,7 +1214,7 @@ def saliency_map_concept_cover(args, val_loader, layer, arch='resnet_cw', datase
                 for q in range(0, input_size[3]-cover_size+1, 5):
                     new_input = input.clone()
                     new_input[0,:,p:p+cover_size, q:q+cover_size] = random_patch
-                    input_var = torch.autograd.Variable(new_input).cuda()
+                    input_var = new_input.cuda()
                     output = model(input_var)
                     new_activations = nn.functional.max_pool2d(outputs[0], kernel_size=3, stride=3)
                     new_activations = new_activations[0,:,:,:].clamp(min=0.0).mean(dim=(1,2))
@@ -1384,7 +1261,6 @@ def saliency_map_concept_cover_2(args, val_loader, layer, arch='resnet_cw', data
     #print(model)
     model.eval()
     model = model.module
-    layers = model.layers
     if args.arch == "resnet_cw":
         model = model.model
     
@@ -1396,14 +1272,7 @@ def saliency_map_concept_cover_2(args, val_loader, layer, arch='resnet_cw', data
         outputs.append(output)
     
     layer = int(layer)
-    if layer <= layers[0]:
-        model.layer1[layer-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1]:
-        model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2]:
-        model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hook)
-    elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-        model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hook)
+    get_bn1_modules(model)[layer-1].register_forward_hook(hook)
 
     for j in range(num_concepts,num_concepts+1):
         save_folder = os.path.join(dst, "concept_"+str(j))
@@ -1419,7 +1288,7 @@ def saliency_map_concept_cover_2(args, val_loader, layer, arch='resnet_cw', data
     with torch.no_grad():
         for i, (input, target) in enumerate(val_loader):
             random_patch = torch.tensor(np.random.normal(size=(3,cover_size,cover_size)))
-            input_var = torch.autograd.Variable(input).cuda()
+            input_var = input.cuda()
             output = model(input_var)
             base_activations = nn.functional.max_pool2d(outputs[0], kernel_size=3, stride=3)
             base_activations = base_activations[0,:,:,:].clamp(min=0.0).mean(dim=(1,2))
@@ -1433,7 +1302,7 @@ def saliency_map_concept_cover_2(args, val_loader, layer, arch='resnet_cw', data
                 for q in range(0, input_size[3]-cover_size+1, 5):
                     new_input = input.clone()
                     new_input[0,:,p:p+cover_size, q:q+cover_size] = random_patch
-                    input_var = torch.autograd.Variable(new_input).cuda()
+                    input_var = new_input.cuda()
                     output = model(input_var)
                     new_activations = nn.functional.max_pool2d(outputs[0], kernel_size=3, stride=3)
                     new_activations = new_activations[0,:,:,:].clamp(min=0.0).mean(dim=(1,2))
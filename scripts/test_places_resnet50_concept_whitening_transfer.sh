@@ -1,2 +1,2 @@
 #!/bin/sh
-python3 ../train_places.py --ngpu 1 --workers 4 --arch resnet_cw --depth 50 --epochs 200 --batch-size 32 --lr 0.05 --whitened_layers 5 --concepts airplane,bed,person --prefix RESNET50_PLACES365_CPT_WHITEN_TRANSFER --resume ./checkpoints/RESNET50_PLACES365_CPT_WHITEN_TRANSFER_model_best.pth.tar /usr/xtmp/zhichen/data_256/ --evaluate
\ No newline at end of file
+torchrun --nproc_per_node=1 ../train_places.py --ngpu 1 --workers 4 --arch resnet_cw --depth 50 --epochs 200 --batch-size 32 --lr 0.05 --whitened_layers 5 --concepts airplane,bed,person --prefix RESNET50_PLACES365_CPT_WHITEN_TRANSFER --resume ./checkpoints/RESNET50_PLACES365_CPT_WHITEN_TRANSFER_model_best.pth.tar /usr/xtmp/zhichen/data_256/ --evaluate
\ No newline at end of file
@@ -39,8 +39,8 @@ parser.add_argument('--depth', default=18, type=int, metavar='D',
                     help='model depth')
 parser.add_argument('--ngpu', default=4, type=int, metavar='G',
                     help='number of gpus to use')
-parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
-                    help='number of data loading workers (default: 4)')
+parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
 parser.add_argument('--epochs', default=100, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -110,9 +110,19 @@ def main():
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
                            momentum=args.momentum,
                            weight_decay=args.weight_decay)
+    # same decay adjust_learning_rate implemented by hand, in closed
+    # form: LambdaLR re-derives lr * 0.1**(epoch//30) from initial_lr
+    # on every step, so the LR depends only on the absolute epoch and
+    # --start-epoch works without loading optimizer state
+    for param_group in optimizer.param_groups:
+        param_group.setdefault('initial_lr', args.lr)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda epoch: 0.1 ** (epoch // 30),
+                                                  last_epoch=args.start_epoch - 1)
                             
     model = torch.nn.DataParallel(model, device_ids=list(range(args.ngpu)))
     model = model.cuda()
+    # NHWC layout lets cuDNN pick tensor-core kernels for the convs
+    model = model.to(memory_format=torch.channels_last)
     print("model")
     print(model)
 
@@ -145,7 +155,8 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
         for concept in args.concepts.split(',')
     ]
     
@@ -158,7 +169,8 @@ def main():
     print(args.test_weights)
     test_loader = torch.utils.data.DataLoader(test_dataset,
         batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
 
     test_loader_with_path = torch.utils.data.DataLoader(
         ImageFolderWithPaths(testdir, transforms.Compose([
@@ -168,7 +180,8 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
 
     val_loader_2 = torch.utils.data.DataLoader(
         datasets.ImageFolder('/usr/xtmp/zhichen/ConceptWhitening_git/ConceptWhitening/plot/age_le_20_size_geeq_10/resnet_cw18/76_dim_pos/', transforms.Compose([
@@ -178,14 +191,14 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
     # model = load_resnet_model(args, arch = args.arch, depth=args.depth, whitened_layer=args.whitened_layers, dataset = 'isic')
 
     if args.evaluate == False:
         print("Start training")
         best_prec1 = 0
         for epoch in range(args.start_epoch, args.start_epoch + 100):
-            adjust_learning_rate(optimizer, epoch)
             
             # train for one epoch
             if args.arch == "resnet_cw" or args.arch == "resnet_original":
@@ -196,6 +209,8 @@ def main():
             # evaluate on validation set
             prec1 = validate(test_loader, model, criterion, epoch)
             
+            scheduler.step()
+
             # remember best prec@1 and save checkpoint
             is_best = prec1 > best_prec1
             best_prec1 = max(prec1, best_prec1)
@@ -205,6 +220,7 @@ def main():
                 'state_dict': model.state_dict(),
                 'best_prec1': best_prec1,
                 'optimizer' : optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
             }, is_best, args.prefix)
         print(best_prec1)
         validate(test_loader, model, criterion, epoch)
@@ -242,7 +258,7 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
         #             # print(concept_index)
         #             model.module.change_mode(concept_index)
         #             for j, (X, _) in enumerate(concept_loader):
-        #                 X_var = torch.autograd.Variable(X).cuda()
+        #                 X_var = X.cuda()
         #                 model(X_var)
         #                 break
         #         model.module.update_rotation_matrix()
@@ -252,18 +268,18 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
         # measure data loading time
         data_time.update(time.time() - end)
         
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
+        # overlap H2D copies from pinned memory with compute
+        input = input.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+        target = target.cuda(non_blocking=True)
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        output = model(input)
+        loss = criterion(output, target)
         # measure accuracy and record loss
         [prec1] = accuracy(output.data, target, topk=(1,))
-        losses.update(loss.data, input.size(0))
+        losses.update(loss.item(), input.size(0))
         top1.update(prec1.item(), input.size(0))
         # compute gradient and do SGD step
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         optimizer.step()
         # measure elapsed time
@@ -291,17 +307,16 @@ def validate(val_loader, model, criterion, epoch):
     end = time.time()
     with torch.no_grad():
         for i, (input, target) in enumerate(val_loader):
-            target = target.cuda(async=True)
-            input_var = torch.autograd.Variable(input)
-            target_var = torch.autograd.Variable(target)
-            
+            input = input.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+            target = target.cuda(non_blocking=True)
+
             # compute output
-            output = model(input_var)
-            loss = criterion(output, target_var)
+            output = model(input)
+            loss = criterion(output, target)
             # measure accuracy and record loss
             [prec1] = accuracy(output.data, target, topk=(1,))
             [bacc] = weighted_accuracy(output.data, target)
-            losses.update(loss.data, input.size(0))
+            losses.update(loss.item(), input.size(0))
             top1.update(prec1.item(), input.size(0))
             baccs.update(bacc.item(), input.size(0))
             
@@ -355,22 +370,14 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
             #model.eval()
             
             layer = int(args.whitened_layers)
-            layers = model.module.layers
-            if layer <= layers[0]:
-                hook = model.module.model.layer1[layer-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1]:
-                hook = model.module.model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                hook = model.module.model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                hook = model.module.model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hookf)
-            
+            hook = get_bn1_modules(model.module.model)[layer-1].register_forward_hook(hookf)
+
             y = []
             inter_feature = []
             for concept_index, concept_loader in enumerate(concept_loaders):
                 for j, (X, _) in enumerate(concept_loader):
                     y += [concept_index] * X.size(0)
-                    X_var = torch.autograd.Variable(X).cuda()
+                    X_var = X.cuda()
                     model(X_var)
                     break
             
@@ -391,10 +398,10 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
             loss_cpt = criterion(y_pred, y_var)
             # measure accuracy and record loss
             [prec1_cpt] = accuracy(y_pred.data, y_var, topk=(1,))
-            loss_aux.update(loss_cpt.data, f_size[0])
-            top1_cpt.update(prec1_cpt[0], f_size[0])
+            loss_aux.update(loss_cpt.item(), f_size[0])
+            top1_cpt.update(prec1_cpt.item(), f_size[0])
             
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss_cpt.backward()
             optimizer.step()
 
@@ -403,22 +410,21 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
         # measure data loading time
         data_time.update(time.time() - end)
         
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        
+        input = input.cuda(non_blocking=True)
+        target = target.cuda(non_blocking=True)
+
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
-        
+        output = model(input)
+        loss = criterion(output, target)
+
         # measure accuracy and record loss
         prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data, input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
         
         # compute gradient and do SGD step
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         optimizer.step()
         
@@ -494,7 +500,10 @@ def save_checkpoint(state, is_best, prefix, checkpoint_folder='./checkpoints'):
     if not os.path.exists(os.path.join(checkpoint_folder,concept_name)):
         os.mkdir(os.path.join(checkpoint_folder,concept_name))
     filename = os.path.join(checkpoint_folder,concept_name,'%s_checkpoint.pth.tar'%prefix)
-    torch.save(state, filename)
+    # write to a temp file first so a crash mid-save cannot truncate the
+    # previous checkpoint; os.replace is atomic on the same filesystem
+    torch.save(state, filename + '.tmp', pickle_protocol=4)
+    os.replace(filename + '.tmp', filename)
     if is_best:
          shutil.copyfile(filename, os.path.join(checkpoint_folder,concept_name,'%s_model_best.pth.tar'%prefix))
     # filename = os.path.join(checkpoint_folder,'%s_checkpoint.pth.tar'%prefix)
@@ -521,25 +530,18 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def adjust_learning_rate(optimizer, epoch):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1 ** (epoch // 30))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     maxk = max(topk)
     batch_size = target.size(0)
 
     _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
+    correct = pred.eq(target.unsqueeze(1))
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+        # topk is sorted, so a hit in the first k columns is a top-k hit
+        correct_k = correct[:, :k].any(dim=1).float().sum()
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
@@ -609,7 +611,8 @@ def balanced_data_loader(args, dataset_dir, loader_type = 'train'):
     weights = torch.DoubleTensor(weights)
     sampler = torch.utils.data.sampler.WeightedRandomSampler(weights, len(weights))
     loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle = False,
-        sampler = sampler, num_workers=args.workers, pin_memory=False)
+        sampler = sampler, num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
 
     return loader
 
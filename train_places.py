@@ -12,8 +12,11 @@ import torch.nn as nn
 import torch.nn.parallel
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.optim
 import torch.utils.data
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
@@ -21,6 +24,19 @@ from MODELS.model_resnet import *
 from plot_functions import *
 from PIL import ImageFile, Image
 
+try:
+    from nvidia.dali import pipeline_def, fn, types
+    from nvidia.dali.plugin.pytorch import DALIClassificationIterator, LastBatchPolicy
+    has_dali = True
+except ImportError:
+    has_dali = False
+
+try:
+    from torchvision.io import read_file, decode_jpeg, ImageReadMode
+    has_gpu_decode = torch.cuda.is_available()
+except ImportError:
+    has_gpu_decode = False
+
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
@@ -39,8 +55,8 @@ parser.add_argument('--depth', default=18, type=int, metavar='D',
                     help='model depth')
 parser.add_argument('--ngpu', default=4, type=int, metavar='G',
                     help='number of gpus to use')
-parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
-                    help='number of data loading workers (default: 4)')
+parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
+                    help='number of data loading workers (default: 8)')
 parser.add_argument('--epochs', default=100, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -68,11 +84,198 @@ os.chdir(sys.path[0])
 if not os.path.exists('./checkpoints'):
     os.mkdir('./checkpoints')
 
+if has_dali:
+    @pipeline_def
+    def create_dali_pipeline(data_dir, crop, shard_id=0, num_shards=1, training=True):
+        images, labels = fn.readers.file(file_root=data_dir,
+                                         shard_id=shard_id,
+                                         num_shards=num_shards,
+                                         shuffle_after_epoch=training,
+                                         name="Reader")
+        # decode on GPU (nvJPEG/HW decoder), then augment on device
+        images = fn.decoders.image(images, device="mixed", output_type=types.RGB)
+        if training:
+            images = fn.random_resized_crop(images, size=crop, device="gpu")
+            mirror = fn.random.coin_flip(probability=0.5)
+        else:
+            images = fn.resize(images, device="gpu", resize_shorter=256)
+            mirror = False
+        images = fn.crop_mirror_normalize(images,
+                                          dtype=types.FLOAT,
+                                          output_layout="CHW",
+                                          crop=(crop, crop),
+                                          mean=[0.485*255, 0.456*255, 0.406*255],
+                                          std=[0.229*255, 0.224*255, 0.225*255],
+                                          mirror=mirror)
+        labels = labels.gpu()
+        return images, labels
+
+class DALILoader(object):
+    """
+    Wraps DALIClassificationIterator so that it yields (input, target)
+    tuples like an ordinary DataLoader. Decode + augmentation all happen
+    on the GPU, so the tensors it yields are already on device.
+    """
+    def __init__(self, data_dir, batch_size, workers, crop=224, training=True,
+                 device_id=0, shard_id=0, num_shards=1):
+        pipe = create_dali_pipeline(batch_size=batch_size, num_threads=workers,
+                                    device_id=device_id, seed=args.seed,
+                                    data_dir=data_dir, crop=crop,
+                                    shard_id=shard_id, num_shards=num_shards,
+                                    training=training)
+        pipe.build()
+        # dropping the ragged last batch is fine for training, but
+        # validation has to see every sample
+        policy = LastBatchPolicy.DROP if training else LastBatchPolicy.PARTIAL
+        self.loader = DALIClassificationIterator(pipe, reader_name="Reader",
+                                                 auto_reset=True,
+                                                 last_batch_policy=policy)
+
+    def __iter__(self):
+        for data in self.loader:
+            yield data[0]["data"], data[0]["label"].squeeze(-1).long()
+
+    def __len__(self):
+        return len(self.loader)
+
+class CUDAPrefetcher(object):
+    """
+    Pulls the next (input, target) batch on a dedicated copy stream so
+    the H2D transfer of batch N+1 overlaps with the forward/backward of
+    batch N. record_stream hands the tensors over to the compute stream
+    so the caching allocator does not recycle the pinned buffers while
+    the copy stream is still writing them.
+    """
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_input, self.next_target = next(self.loader)
+        except StopIteration:
+            self.next_input = None
+            self.next_target = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_input = self.next_input.cuda(non_blocking=True)
+            self.next_target = self.next_target.cuda(non_blocking=True)
+
+    def next(self):
+        if self.next_input is None:
+            return None, None
+        torch.cuda.current_stream().wait_stream(self.stream)
+        input = self.next_input
+        target = self.next_target
+        input.record_stream(torch.cuda.current_stream())
+        target.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return input, target
+
+class RawJPEGFolder(datasets.ImageFolder):
+    """
+    ImageFolder variant whose workers only read the raw JPEG bytes from
+    disk. The Huffman/IDCT decode is deferred to the GPU (nvJPEG) in
+    NVJPEGLoader, so the workers stay cheap and I/O bound.
+    """
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        return read_file(path), target
+
+def raw_jpeg_collate(batch):
+    # the encoded streams have different lengths, keep them as a list
+    raws = [raw for raw, _ in batch]
+    targets = torch.tensor([target for _, target in batch])
+    return raws, targets
+
+class NVJPEGLoader(object):
+    """
+    Middle tier between DALI and the PIL pipeline: the workers hand over
+    raw JPEG bytes, the whole batch is decoded with nvJPEG
+    (torchvision.io.decode_jpeg on device) and augmented on the GPU, so
+    preprocessing throughput is bounded by the GPU decoder instead of
+    the CPU workers.
+    """
+    def __init__(self, dataset, batch_size, workers, crop=224, training=True,
+                 shuffle=False, sampler=None):
+        self.loader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+            num_workers=workers, pin_memory=True,
+            persistent_workers=True, prefetch_factor=2, collate_fn=raw_jpeg_collate)
+        self.crop = crop
+        self.training = training
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1).mul_(255).cuda()
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1).mul_(255).cuda()
+
+    def __iter__(self):
+        for raws, targets in self.loader:
+            images = decode_jpeg(raws, mode=ImageReadMode.RGB, device='cuda')
+            batch = torch.empty((len(images), 3, self.crop, self.crop), device='cuda')
+            for j, img in enumerate(images):
+                if self.training:
+                    i, t, h, w = transforms.RandomResizedCrop.get_params(
+                        img, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.))
+                    img = transforms.functional.resized_crop(img, i, t, h, w, [self.crop, self.crop])
+                    if torch.rand(()) < 0.5:
+                        img = transforms.functional.hflip(img)
+                else:
+                    img = transforms.functional.resize(img, 256)
+                    img = transforms.functional.center_crop(img, self.crop)
+                batch[j] = img
+            batch.sub_(self.mean).div_(self.std)
+            yield batch, targets.cuda(non_blocking=True)
+
+    def __len__(self):
+        return len(self.loader)
+
+def build_concept_cache(concept_loaders):
+    """
+    The concept images are revisited every 30 training steps, which
+    re-decodes and re-transforms the same small datasets over and over.
+    Run each concept loader once, keep the batches as host tensors, and
+    page-lock them in place with cudaHostRegister so every later
+    transfer is a plain non_blocking DMA copy out of memory that never
+    has to be staged or pinned again.
+    """
+    cudart = torch.cuda.cudart()
+    concept_cache = []
+    for concept_loader in concept_loaders:
+        batches = []
+        for X, _ in concept_loader:
+            X = X.cpu() if X.is_cuda else X.contiguous()
+            if not X.is_pinned():
+                cudart.cudaHostRegister(X.data_ptr(), X.numel() * X.element_size(), 0)
+            batches.append(X)
+        if len(batches) == 0:
+            # a DROP-policy loader over a folder with fewer images than
+            # batch_size yields nothing; fail here with a clear message
+            # instead of a ZeroDivisionError in train()
+            raise Exception("concept loader {} produced no batches, "
+                            "need at least batch_size images per concept folder!".format(len(concept_cache)))
+        concept_cache.append(batches)
+    return concept_cache
+
 def main():
     global args, best_prec1
     args = parser.parse_args()
 
-    print ("args", args)
+    # one process per GPU when launched with torchrun; fill in the env
+    # vars ourselves so a plain `python3 train_places.py` run still
+    # works as a single-process group
+    if "LOCAL_RANK" not in os.environ:
+        os.environ["LOCAL_RANK"] = "0"
+        os.environ.setdefault("RANK", "0")
+        os.environ.setdefault("WORLD_SIZE", "1")
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+    dist.init_process_group(backend='nccl')
+    args.local_rank = int(os.environ["LOCAL_RANK"])
+    args.world_size = dist.get_world_size()
+    torch.cuda.set_device(args.local_rank)
+
+    if args.local_rank == 0:
+        print ("args", args)
 
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
@@ -108,16 +311,31 @@ def main():
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
                            momentum=args.momentum,
                            weight_decay=args.weight_decay)
+    # same decay adjust_learning_rate implemented by hand, in closed
+    # form: LambdaLR re-derives lr * 0.1**(epoch//30) from initial_lr
+    # on every step, so the LR depends only on the absolute epoch and
+    # --start-epoch works without loading optimizer state
+    for param_group in optimizer.param_groups:
+        param_group.setdefault('initial_lr', args.lr)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda epoch: 0.1 ** (epoch // 30),
+                                                  last_epoch=args.start_epoch - 1)
                             
-    model = torch.nn.DataParallel(model, device_ids=list(range(args.ngpu)))
-    model = model.cuda()
-    print ("model")
-    print (model)
-
-    # get the number of model parameters
-    print('Number of model parameters: {}'.format(
-        sum([p.data.nelement() for p in model.parameters()])))
-    
+    model = model.cuda(args.local_rank)
+    # NHWC layout lets cuDNN pick tensor-core kernels for the convs
+    model = model.to(memory_format=torch.channels_last)
+    # gradient bucketing overlaps the allreduce with backward, unlike
+    # DataParallel which scatters/gathers everything through GPU0
+    model = DistributedDataParallel(model, device_ids=[args.local_rank])
+    # loss scaling for mixed-precision training
+    scaler = torch.cuda.amp.GradScaler()
+    if args.local_rank == 0:
+        print ("model")
+        print (model)
+
+        # get the number of model parameters
+        print('Number of model parameters: {}'.format(
+            sum([p.data.nelement() for p in model.parameters()])))
+
     cudnn.benchmark = True
 
     # Data loading code
@@ -129,38 +347,76 @@ def main():
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
 
-    train_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(traindir, transforms.Compose([
-            transforms.RandomSizedCrop(224),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
-
-    concept_loaders = [
-        torch.utils.data.DataLoader(
-        datasets.ImageFolder(os.path.join(conceptdir_train, concept), transforms.Compose([
-            transforms.RandomSizedCrop(224),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
-        for concept in args.concepts.split(',')
-    ]
-
-    val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            transforms.Scale(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
+    train_sampler = None
+    if has_dali:
+        # decode/augment the heavy loaders on GPU, the CPU transform
+        # pipeline is the bottleneck on ImageNet-sized images
+        train_loader = DALILoader(traindir, args.batch_size, args.workers,
+                                  device_id=args.local_rank,
+                                  shard_id=args.local_rank, num_shards=args.world_size)
+        concept_loaders = [
+            DALILoader(os.path.join(conceptdir_train, concept), args.batch_size, args.workers,
+                       device_id=args.local_rank,
+                       shard_id=args.local_rank, num_shards=args.world_size)
+            for concept in args.concepts.split(',')
+        ]
+        val_loader = DALILoader(valdir, args.batch_size, args.workers, training=False,
+                                device_id=args.local_rank,
+                                shard_id=args.local_rank, num_shards=args.world_size)
+    elif has_gpu_decode:
+        # no DALI, but torchvision can still hand the JPEG decode to
+        # nvJPEG; only the file reads stay on the CPU workers
+        train_dataset = RawJPEGFolder(traindir)
+        train_sampler = DistributedSampler(train_dataset)
+        train_loader = NVJPEGLoader(train_dataset, args.batch_size, args.workers,
+                                    sampler=train_sampler)
+        concept_loaders = [
+            NVJPEGLoader(RawJPEGFolder(os.path.join(conceptdir_train, concept)),
+                         args.batch_size, args.workers, shuffle=True)
+            for concept in args.concepts.split(',')
+        ]
+        val_dataset = RawJPEGFolder(valdir)
+        val_loader = NVJPEGLoader(val_dataset, args.batch_size, args.workers, training=False,
+                                  sampler=DistributedSampler(val_dataset, shuffle=False))
+    else:
+        train_dataset = datasets.ImageFolder(traindir, transforms.Compose([
+                transforms.RandomSizedCrop(224),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                normalize,
+            ]))
+        train_sampler = DistributedSampler(train_dataset)
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.batch_size, sampler=train_sampler,
+            num_workers=args.workers, pin_memory=True,
+            persistent_workers=True, prefetch_factor=2)
+
+        concept_loaders = [
+            torch.utils.data.DataLoader(
+            datasets.ImageFolder(os.path.join(conceptdir_train, concept), transforms.Compose([
+                transforms.RandomSizedCrop(224),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                normalize,
+            ])),
+            batch_size=args.batch_size, shuffle=True,
+            num_workers=args.workers, pin_memory=True,
+            persistent_workers=True, prefetch_factor=2)
+            for concept in args.concepts.split(',')
+        ]
+
+        val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
+                transforms.Scale(256),
+                transforms.CenterCrop(224),
+                transforms.ToTensor(),
+                normalize,
+            ]))
+        val_loader = torch.utils.data.DataLoader(
+            val_dataset,
+            batch_size=args.batch_size, sampler=DistributedSampler(val_dataset, shuffle=False),
+            num_workers=args.workers, pin_memory=True,
+            persistent_workers=True, prefetch_factor=2)
 
     val_loader_2 = torch.utils.data.DataLoader(
         datasets.ImageFolder('/usr/xtmp/zhichen/ConceptWhitening_git/ConceptWhitening/plot/airplane_bed_bench_boat_book_horse_person/resnet_cw18/1_rot_cw_top5', transforms.Compose([
@@ -170,7 +426,8 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
     
     test_loader = torch.utils.data.DataLoader(
         datasets.ImageFolder(testdir, transforms.Compose([
@@ -180,7 +437,8 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
 
     test_loader_with_path = torch.utils.data.DataLoader(
         ImageFolderWithPaths(testdir, transforms.Compose([
@@ -190,33 +448,43 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=False)
+        num_workers=args.workers, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2)
 
     if args.evaluate == False:
-        print("Start training")
+        if args.local_rank == 0:
+            print("Start training")
         best_prec1 = 0
+        if args.arch == "resnet_cw":
+            concept_loaders = build_concept_cache(concept_loaders)
         for epoch in range(args.start_epoch, args.start_epoch + 4):
-            adjust_learning_rate(optimizer, epoch)
-            
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+
             # train for one epoch
             if args.arch == "resnet_cw":
-                train(train_loader, concept_loaders, model, criterion, optimizer, epoch)
+                train(train_loader, concept_loaders, model, criterion, optimizer, epoch, scaler)
             elif args.arch == "resnet_baseline":
                 train_baseline(train_loader, concept_loaders, model, criterion, optimizer, epoch)
             # evaluate on validation set
             prec1 = validate(val_loader, model, criterion, epoch)
             
-            # remember best prec@1 and save checkpoint
+            scheduler.step()
+
+            # remember best prec@1 and save checkpoint (rank 0 only)
             is_best = prec1 > best_prec1
             best_prec1 = max(prec1, best_prec1)
-            save_checkpoint({
-                'epoch': epoch + 1,
-                'arch': args.arch,
-                'state_dict': model.state_dict(),
-                'best_prec1': best_prec1,
-                'optimizer' : optimizer.state_dict(),
-            }, is_best, args.prefix)
-        print(best_prec1)
+            if args.local_rank == 0:
+                save_checkpoint({
+                    'epoch': epoch + 1,
+                    'arch': args.arch,
+                    'state_dict': model.state_dict(),
+                    'best_prec1': best_prec1,
+                    'optimizer' : optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                }, is_best, args.prefix)
+        if args.local_rank == 0:
+            print(best_prec1)
         validate(test_loader, model, criterion, epoch)
     else:
         # model = load_resnet_model(args, arch = 'resnet_baseline', depth=args.depth, whitened_layer=args.whitened_layers)
@@ -251,7 +519,7 @@ def main():
         # plot_figures(args, model, test_loader_with_path, train_loader, concept_loaders, conceptdir_test)
         saliency_map_concept_cover(args, val_loader_2, '1', arch='resnet_cw', dataset='places365', num_concepts=7)
 
-def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
+def train(train_loader, concept_loaders, model, criterion, optimizer, epoch, scaler):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -261,50 +529,62 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
     # switch to train mode
     model.train()
 
+    # only the normalization layers behave differently in eval mode, so
+    # the concept pass flips just these instead of walking the whole
+    # module tree with model.eval()/model.train() every 30 iterations
+    norm_layers = [m for m in model.modules()
+                   if isinstance(m, (nn.modules.batchnorm._BatchNorm, cw_layer))]
+
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    prefetcher = CUDAPrefetcher(train_loader)
+    input, target = prefetcher.next()
+    i = -1
+    while input is not None:
+        i += 1
         # if (i + 1) % 800 == 0:
         #     break
         if (i + 1) % 30 == 0:
-            model.eval()
+            for m in norm_layers:
+                m.eval()
             with torch.no_grad():
-                # update the gradient matrix G
-                for concept_index, concept_loader in enumerate(concept_loaders):
+                # update the gradient matrix G, round-robin over the
+                # pinned concept batches instead of re-reading from disk
+                for concept_index, concept_batches in enumerate(concept_loaders):
                     model.module.change_mode(concept_index)
-                    for j, (X, _) in enumerate(concept_loader):
-                        X_var = torch.autograd.Variable(X).cuda()
-                        model(X_var)
-                        break
+                    X = concept_batches[((i + 1) // 30) % len(concept_batches)]
+                    model(X.cuda(non_blocking=True))
                 model.module.update_rotation_matrix()
                 # change to ordinary mode
                 model.module.change_mode(-1)
-            model.train()
+            for m in norm_layers:
+                m.train()
         # measure data loading time
         data_time.update(time.time() - end)
-        
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        
-        # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
-        
+
+        # the prefetcher already moved input/target to the GPU
+        input = input.contiguous(memory_format=torch.channels_last)
+
+        # compute output in FP16 on the tensor cores
+        with torch.cuda.amp.autocast(dtype=torch.float16):
+            output = model(input)
+            loss = criterion(output, target)
+
         # measure accuracy and record loss
         prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data, input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
-        
-        # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
+
+        # compute gradient and do SGD step with loss scaling
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
-        
+
         if i % args.print_freq == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
@@ -314,7 +594,9 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
                   'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
                    epoch, i, len(train_loader), batch_time=batch_time,
                    data_time=data_time, loss=losses, top1=top1, top5=top5))
-  
+
+        input, target = prefetcher.next()
+
 
 def validate(val_loader, model, criterion, epoch):
     batch_time = AverageMeter()
@@ -327,18 +609,18 @@ def validate(val_loader, model, criterion, epoch):
     end = time.time()
     with torch.no_grad():
         for i, (input, target) in enumerate(val_loader):
-            target = target.cuda(async=True)
-            input_var = torch.autograd.Variable(input)
-            target_var = torch.autograd.Variable(target)
-            
+            input = input.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+            target = target.cuda(non_blocking=True)
+
             # compute output
-            output = model(input_var)
-            loss = criterion(output, target_var)
+            with torch.cuda.amp.autocast(dtype=torch.float16):
+                output = model(input)
+                loss = criterion(output, target)
             # measure accuracy and record loss
             prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-            losses.update(loss.data, input.size(0))
-            top1.update(prec1[0], input.size(0))
-            top5.update(prec5[0], input.size(0))
+            losses.update(loss.item(), input.size(0))
+            top1.update(prec1.item(), input.size(0))
+            top5.update(prec5.item(), input.size(0))
             
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -390,22 +672,14 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
             #model.eval()
             
             layer = int(args.whitened_layers)
-            layers = model.module.layers
-            if layer <= layers[0]:
-                hook = model.module.model.layer1[layer-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1]:
-                hook = model.module.model.layer2[layer-layers[0]-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1] + layers[2]:
-                hook = model.module.model.layer3[layer-layers[0]-layers[1]-1].bn1.register_forward_hook(hookf)
-            elif layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                hook = model.module.model.layer4[layer-layers[0]-layers[1]-layers[2]-1].bn1.register_forward_hook(hookf)
-            
+            hook = get_bn1_modules(model.module.model)[layer-1].register_forward_hook(hookf)
+
             y = []
             inter_feature = []
             for concept_index, concept_loader in enumerate(concept_loaders):
                 for j, (X, _) in enumerate(concept_loader):
                     y += [concept_index] * X.size(0)
-                    X_var = torch.autograd.Variable(X).cuda()
+                    X_var = X.cuda()
                     model(X_var)
                     break
             
@@ -426,10 +700,10 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
             loss_cpt = 10*criterion(y_pred, y_var)
             # measure accuracy and record loss
             [prec1_cpt] = accuracy(y_pred.data, y_var, topk=(1,))
-            loss_aux.update(loss_cpt.data, f_size[0])
-            top1_cpt.update(prec1_cpt[0], f_size[0])
+            loss_aux.update(loss_cpt.item(), f_size[0])
+            top1_cpt.update(prec1_cpt.item(), f_size[0])
             
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss_cpt.backward()
             optimizer.step()
 
@@ -437,23 +711,22 @@ def train_baseline(train_loader, concept_loaders, model, criterion, optimizer, e
             #model.train()
         # measure data loading time
         data_time.update(time.time() - end)
-        
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        
+
+        input = input.cuda(non_blocking=True)
+        target = target.cuda(non_blocking=True)
+
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
-        
+        output = model(input)
+        loss = criterion(output, target)
+
         # measure accuracy and record loss
         prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data, input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
         
         # compute gradient and do SGD step
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         optimizer.step()
         
@@ -542,7 +815,10 @@ def save_checkpoint(state, is_best, prefix, checkpoint_folder='./checkpoints'):
     if not os.path.exists(os.path.join(checkpoint_folder,concept_name)):
         os.mkdir(os.path.join(checkpoint_folder,concept_name))
     filename = os.path.join(checkpoint_folder,concept_name,'%s_checkpoint.pth.tar'%prefix)
-    torch.save(state, filename)
+    # write to a temp file first so a crash mid-save cannot truncate the
+    # previous checkpoint; os.replace is atomic on the same filesystem
+    torch.save(state, filename + '.tmp', pickle_protocol=4)
+    os.replace(filename + '.tmp', filename)
     if is_best:
          shutil.copyfile(filename, os.path.join(checkpoint_folder,concept_name,'%s_model_best.pth.tar'%prefix))
 
@@ -565,25 +841,18 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def adjust_learning_rate(optimizer, epoch):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1 ** (epoch // 30))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     maxk = max(topk)
     batch_size = target.size(0)
 
     _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
+    correct = pred.eq(target.unsqueeze(1))
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+        # topk is sorted, so a hit in the first k columns is a top-k hit
+        correct_k = correct[:, :k].any(dim=1).float().sum()
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 